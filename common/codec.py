@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+import json
+import os
+import zlib
+from typing import Any, Optional
+
+# msgpack and orjson are optional: without them messages fall back to the
+# standard library json module
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+DEFLATE = 'deflate'
+
+# content type requests are sent in. replies use the content type of their request.
+# json through orjson encodes and decodes our messages faster than msgpack
+# (see test/bench_codec.py), msgpack only makes them slightly smaller
+RPC_CONTENT_TYPE = os.environ.get('RPC_CONTENT_TYPE', JSON)
+# bodies of at least this many bytes are compressed, 0 turns compression off
+RPC_COMPRESSION_THRESHOLD = int(os.environ.get('RPC_COMPRESSION_THRESHOLD', 4096))
+
+
+def supported(content_type: Optional[str]) -> bool:
+    return content_type == JSON or (content_type == MSGPACK and msgpack is not None)
+
+
+def encode(obj: Any, content_type: Optional[str] = None,
+           compression_threshold: int = RPC_COMPRESSION_THRESHOLD) -> tuple[bytes, str, Optional[str]]:
+    # returns the body with the content type and content encoding to send it with
+    content_type = content_type or RPC_CONTENT_TYPE
+    if not supported(content_type):
+        content_type = JSON
+
+    if content_type == MSGPACK:
+        body = msgpack.packb(obj)
+    elif orjson is not None:
+        body = orjson.dumps(obj)
+    else:
+        body = json.dumps(obj).encode()
+
+    if 0 < compression_threshold <= len(body):
+        return zlib.compress(body, 1), content_type, DEFLATE
+    return body, content_type, None
+
+
+def decode(body: bytes, content_type: Optional[str], content_encoding: Optional[str] = None) -> Any:
+    if content_encoding == DEFLATE:
+        body = zlib.decompress(body)
+
+    if content_type == MSGPACK:
+        if msgpack is None:
+            raise ValueError(f"cannot decode {MSGPACK} without msgpack installed")
+        return msgpack.unpackb(body)
+    # anything else, including the text/plain of older senders, is json
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body.decode())
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+import atexit
+import contextvars
+import os
+import time
+
+# with uvicorn --workers every worker is a process of its own. pointing
+# PROMETHEUS_MULTIPROC_DIR at a directory shared by the workers makes every
+# worker's /metrics report the numbers of all of them. prometheus_client
+# reads the variable on import, and needs the directory to exist by then.
+# the directory has to be emptied before the workers start (see the
+# commands in docker-compose), or it still holds the files of the workers
+# of an earlier run
+MULTIPROCESS_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+if MULTIPROCESS_DIR:
+    os.makedirs(MULTIPROCESS_DIR, exist_ok=True)
+
+from prometheus_client import (  # noqa: E402
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+from pymongo import monitoring  # noqa: E402
+from starlette.responses import Response  # noqa: E402
+
+if MULTIPROCESS_DIR:
+    # drops this worker's live gauges, such as the requests it has in
+    # flight, from the sums once it exits
+    atexit.register(multiprocess.mark_process_dead, os.getpid())
+
+# from half a millisecond, for cached reads, up to the RPC timeout
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Time to answer an HTTP request',
+    ['method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+RPC_SECONDS = Histogram(
+    'rpc_round_trip_seconds', 'Time from sending a request over the broker to decoding its reply',
+    ['queue', 'operation', 'outcome'], buckets=LATENCY_BUCKETS)
+RPC_IN_FLIGHT = Gauge(
+    'rpc_in_flight_requests', 'Requests sent over the broker that still wait for their reply',
+    multiprocess_mode='livesum')
+HANDLER_SECONDS = Histogram(
+    'queue_handler_duration_seconds', 'Time a queue handler spent on one message',
+    ['queue', 'operation'], buckets=LATENCY_BUCKETS)
+MONGO_COMMAND_SECONDS = Histogram(
+    'mongo_command_duration_seconds', 'Round trip of one command to mongo',
+    ['operation', 'command', 'outcome'], buckets=LATENCY_BUCKETS)
+TRANSACTION_ABORTS = Counter(
+    'mongo_transaction_aborts_total', 'Transactions that did not commit',
+    ['operation', 'reason'])
+
+# what the current task is working on: the operation of a queue message,
+# or http for requests handled without the queue. mongo commands are
+# labelled with it
+current_operation: contextvars.ContextVar[str] = contextvars.ContextVar('current_operation', default='background')
+
+
+class CommandMetrics(monitoring.CommandListener):
+    # motor runs commands in threads that carry the context of the task that
+    # issued them, so current_operation is that task's
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        MONGO_COMMAND_SECONDS.labels(current_operation.get(), event.command_name, 'ok') \
+            .observe(event.duration_micros / 1e6)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        MONGO_COMMAND_SECONDS.labels(current_operation.get(), event.command_name, 'error') \
+            .observe(event.duration_micros / 1e6)
+
+
+class MetricsMiddleware(object):
+    """Times every HTTP request by the endpoint that answered it.
+
+    A plain ASGI middleware rather than a BaseHTTPMiddleware, which would
+    run every request through an extra task and memory stream.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        current_operation.set('http')
+
+        async def send_with_status(message) -> None:
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # the router puts the matched endpoint into the scope
+            endpoint = scope.get('endpoint')
+            route = endpoint.__name__ if endpoint is not None else 'unmatched'
+            HTTP_REQUEST_SECONDS.labels(scope['method'], route, str(status)).observe(time.perf_counter() - start)
+
+
+def metrics_response() -> Response:
+    if MULTIPROCESS_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
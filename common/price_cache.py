@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+import logging
+from collections import OrderedDict
+from typing import MutableMapping, Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+
+
+class PriceCache(object):
+    """Bounded LRU cache of item prices.
+
+    An item's price is fixed once the item is created, so cached entries never
+    go stale and only need to be evicted to stay within capacity.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.prices: MutableMapping[str, float] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, item_id: str) -> Optional[float]:
+        price = self.prices.get(item_id)
+        if price is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.prices.move_to_end(item_id)
+        return price
+
+    def put(self, item_id: str, price: float) -> None:
+        self.prices[item_id] = float(price)
+        self.prices.move_to_end(item_id)
+        while len(self.prices) > self.capacity:
+            self.prices.popitem(last=False)
+
+    async def warm(self, collection: AsyncIOMotorCollection) -> None:
+        async for item in collection.find({}, {"price": 1}).limit(self.capacity):
+            self.put(str(item["_id"]), item["price"])
+        LOGGER.info("[price-cache] warmed with %d prices", len(self.prices))
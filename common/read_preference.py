@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+import os
+from typing import Union
+
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+
+ReadPreference = Union[Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest]
+
+# the modes that may be bounded by a maximum staleness, by their mongo name
+STALENESS_MODES = {
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+
+def stale_read_preference(service: str) -> ReadPreference:
+    # the read preference for reads of a service that may be slightly stale,
+    # configured by <SERVICE>_READ_PREFERENCE (a mongo read preference mode
+    # such as secondaryPreferred, primary by default) and
+    # <SERVICE>_MAX_STALENESS_SECONDS (at least 90, -1 for no bound)
+    mode = os.environ.get(f"{service}_READ_PREFERENCE", 'primary')
+    max_staleness = int(os.environ.get(f"{service}_MAX_STALENESS_SECONDS", -1))
+    if mode == 'primary':
+        if max_staleness != -1:
+            raise ValueError(f"{service}_MAX_STALENESS_SECONDS cannot bound reads from the primary")
+        return Primary()
+    if mode not in STALENESS_MODES:
+        raise ValueError(f"unknown read preference {mode!r} in {service}_READ_PREFERENCE")
+    return STALENESS_MODES[mode](max_staleness=max_staleness)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from aio_pika.abc import AbstractIncomingMessage
+from opentelemetry import propagate, trace
+from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+from opentelemetry.trace import Link, Span, SpanKind
+from pymongo import monitoring
+
+# spans go to the OTLP collector at OTEL_EXPORTER_OTLP_ENDPOINT (http, the
+# exporter reads its other OTEL_EXPORTER_OTLP_* settings itself), or as one
+# json document per line to <TRACE_DIR>/<service>-<pid>.jsonl. with neither
+# set nothing is recorded and the spans below cost next to nothing
+OTLP_ENDPOINT = os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT')
+TRACE_DIR = os.environ.get('TRACE_DIR')
+
+# header with the time a request was published, in nanoseconds since the
+# epoch. the wait until a handler picks the request up is measured from it,
+# so it is only as exact as the clocks of the two hosts agree
+SENT_AT_HEADER = 'x-sent-at'
+
+tracer = trace.get_tracer(__name__)
+
+
+def configure_tracing(service: str) -> None:
+    if OTLP_ENDPOINT:
+        # only needed, and installed, where traces go to a collector
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter()
+    elif TRACE_DIR:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        # every uvicorn worker writes a file of its own
+        out = open(os.path.join(TRACE_DIR, f"{service}-{os.getpid()}.jsonl"), 'a')
+        exporter = ConsoleSpanExporter(service_name=service, out=out,
+                                       formatter=lambda span: span.to_json(indent=None) + '\n')
+    else:
+        return
+
+    provider = TracerProvider(resource=Resource.create({SERVICE_NAME: service}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+
+
+def message_headers() -> dict:
+    # the headers that carry the current span over the broker
+    headers = {}
+    if trace.get_current_span().is_recording():
+        propagate.inject(headers)
+        headers[SENT_AT_HEADER] = time.time_ns()
+    return headers
+
+
+def current_link() -> Optional[Link]:
+    # a link to the current span, for spans that do work on behalf of more
+    # than their parent
+    context = trace.get_current_span().get_span_context()
+    return Link(context) if context.is_valid else None
+
+
+@contextmanager
+def consumer_span(queue: str, operation: str, message: AbstractIncomingMessage) -> Iterator[Span]:
+    # continues the trace of a request taken from a queue. the time from
+    # publishing the request until now, spent in the broker and waiting for
+    # a handler, becomes a span of its own before the one for handling it
+    headers = message.headers or {}
+    parent = propagate.extract(headers)
+    now = time.time_ns()
+    sent_at = headers.get(SENT_AT_HEADER)
+    if sent_at is not None:
+        wait = tracer.start_span(f"{queue} wait", context=parent, kind=SpanKind.CONSUMER,
+                                 start_time=min(int(sent_at), now))
+        wait.end(end_time=now)
+
+    with tracer.start_as_current_span(f"{queue} {operation}", context=parent, kind=SpanKind.CONSUMER,
+                                      start_time=now, attributes={
+                                          'messaging.destination': queue,
+                                          'messaging.message_id': message.correlation_id or '',
+                                      }) as span:
+        yield span
+
+
+class TracingMiddleware(object):
+    """Starts a trace for every HTTP request, or continues the one a
+    ``traceparent`` header of the request belongs to.
+
+    The span is named after the endpoint that answered the request, which
+    is only known once the router ran.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        headers = {key.decode('latin-1'): value.decode('latin-1') for key, value in scope['headers']}
+        with tracer.start_as_current_span(f"{scope['method']} {scope['path']}", context=propagate.extract(headers),
+                                          kind=SpanKind.SERVER) as span:
+            async def send_with_status(message) -> None:
+                if message['type'] == 'http.response.start':
+                    span.set_attribute('http.status_code', message['status'])
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                endpoint = scope.get('endpoint')
+                if endpoint is not None:
+                    span.update_name(f"{scope['method']} {endpoint.__name__}")
+
+
+class CommandTracing(monitoring.CommandListener):
+    # a span per mongo command, child of the span of the task that issued it
+    # (motor runs commands in threads that carry that task's context)
+
+    def __init__(self) -> None:
+        self.spans: dict[tuple, Span] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if trace.get_current_span().is_recording():
+            self.spans[event.request_id, event.connection_id] = tracer.start_span(
+                f"mongo {event.command_name}", kind=SpanKind.CLIENT,
+                attributes={'db.system': 'mongodb', 'db.name': event.database_name,
+                            'db.operation': event.command_name})
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        span = self.spans.pop((event.request_id, event.connection_id), None)
+        if span is not None:
+            span.end()
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        span = self.spans.pop((event.request_id, event.connection_id), None)
+        if span is not None:
+            span.set_status(trace.Status(trace.StatusCode.ERROR, str(event.failure)))
+            span.end()
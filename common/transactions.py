@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+import asyncio
+import logging
+import os
+import random
+from collections import Counter
+from typing import Any, Awaitable, Callable, Iterable, TypeVar
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorClientSession
+from pymongo.errors import PyMongoError
+
+from metrics import TRANSACTION_ABORTS
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+
+# how many times one transaction is attempted, and for how many seconds it
+# is retried at most
+TXN_MAX_ATTEMPTS = int(os.environ.get('TXN_MAX_ATTEMPTS', 10))
+TXN_RETRY_BUDGET = float(os.environ.get('TXN_RETRY_BUDGET_SECONDS', 2))
+# the backoff before the n-th retry is drawn from [0, min(max, base * 2^n)]
+TXN_BACKOFF_BASE = float(os.environ.get('TXN_BACKOFF_BASE_MS', 5)) / 1000
+TXN_BACKOFF_MAX = float(os.environ.get('TXN_BACKOFF_MAX_MS', 200)) / 1000
+# number of keys whose conflicts are counted before the rarest are dropped
+MAX_COUNTED_KEYS = 10_000
+
+TRANSIENT_ERROR = 'TransientTransactionError'
+UNKNOWN_COMMIT_RESULT = 'UnknownTransactionCommitResult'
+
+T = TypeVar('T')
+
+
+class UnknownCommitResultError(Exception):
+    """A commit that kept ending without a result until the retry budget ran
+    out. The transaction may or may not have committed."""
+
+
+class TransactionRunner(object):
+    """Runs transactions, retrying the ones that failed on a transient error.
+
+    A transaction that aborts with a ``TransientTransactionError``, such as a
+    write conflict, is run again from the start. A commit that ends with an
+    ``UnknownTransactionCommitResult`` is committed again, without running
+    the transaction body a second time. Retries wait for a jittered,
+    exponentially growing backoff, and stop once a transaction ran out of
+    attempts or of its time budget; the last error is raised then, or an
+    ``UnknownCommitResultError`` when it is not known whether the
+    transaction committed.
+
+    The body gets the session and may abort the transaction itself, in
+    which case nothing is committed. Conflicts are counted per operation and
+    per key, the keys being whatever the caller contends on (items, a user).
+    """
+
+    def __init__(self, client: AsyncIOMotorClient, max_attempts: int = TXN_MAX_ATTEMPTS,
+                 budget: float = TXN_RETRY_BUDGET) -> None:
+        self.client = client
+        self.max_attempts = max_attempts
+        self.budget = budget
+        self.conflicts: Counter = Counter()
+        self.key_conflicts: Counter = Counter()
+        self.failures: Counter = Counter()
+
+    async def run(self, operation: str, keys: Iterable[Any],
+                  body: Callable[[AsyncIOMotorClientSession], Awaitable[T]]) -> T:
+        keys = [str(key) for key in keys]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.budget
+        attempt = 0
+        async with await self.client.start_session() as session:
+            while True:
+                attempt += 1
+                try:
+                    session.start_transaction()
+                    try:
+                        result = await body(session)
+                    except BaseException as e:
+                        if session.in_transaction:
+                            await session.abort_transaction()
+                        if not isinstance(e, PyMongoError):
+                            # mongo errors are counted below, with those of the commit
+                            TRANSACTION_ABORTS.labels(operation, 'error').inc()
+                        raise
+                    if session.in_transaction:
+                        await self.commit(operation, keys, session, deadline)
+                    else:
+                        TRANSACTION_ABORTS.labels(operation, 'aborted').inc()
+                    return result
+                except PyMongoError as e:
+                    if not e.has_error_label(TRANSIENT_ERROR):
+                        TRANSACTION_ABORTS.labels(operation, 'error').inc()
+                        raise
+                    TRANSACTION_ABORTS.labels(operation, 'conflict').inc()
+                    self.count_conflict(operation, keys)
+                    if attempt >= self.max_attempts or loop.time() >= deadline:
+                        self.failures[operation] += 1
+                        LOGGER.warning(f"{operation} on {', '.join(keys)} gave up after {attempt} attempts: {e!r}")
+                        raise
+                    await asyncio.sleep(backoff(attempt))
+
+    async def commit(self, operation: str, keys: list[str], session: AsyncIOMotorClientSession, deadline: float) -> None:
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                await session.commit_transaction()
+                return
+            except PyMongoError as e:
+                # only the commit is retried: the transaction may have been
+                # committed already, so its body must not run again
+                if not e.has_error_label(UNKNOWN_COMMIT_RESULT):
+                    raise
+                if asyncio.get_running_loop().time() >= deadline:
+                    LOGGER.warning(f"gave up on the commit of {operation} on {', '.join(keys)}: {e!r}")
+                    raise UnknownCommitResultError(f"{operation} may or may not have committed") from e
+                LOGGER.info(f"retrying commit of {operation} on {', '.join(keys)}: {e!r}")
+                await asyncio.sleep(backoff(attempt))
+
+    def count_conflict(self, operation: str, keys: list[str]) -> None:
+        self.conflicts[operation] += 1
+        self.key_conflicts.update(keys)
+        if len(self.key_conflicts) > MAX_COUNTED_KEYS:
+            # keeps the most contended keys
+            self.key_conflicts = Counter(dict(self.key_conflicts.most_common(MAX_COUNTED_KEYS // 10)))
+
+    def stats(self, hot_keys: int = 10) -> dict:
+        return {
+            'conflicts': dict(self.conflicts),
+            'failures': dict(self.failures),
+            'hot_keys': dict(self.key_conflicts.most_common(hot_keys)),
+        }
+
+
+def backoff(attempt: int) -> float:
+    return random.uniform(0, min(TXN_BACKOFF_MAX, TXN_BACKOFF_BASE * 2 ** attempt))
@@ -1,15 +1,22 @@
 from http import HTTPStatus
 import os
 import atexit
+import hashlib
+import json
 from bson import ObjectId
 from collections import Counter
+from datetime import datetime, timedelta
 
 from fastapi import FastAPI, HTTPException
-import pymongo
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
-from queue_dispatcher import QueueDispatcher
+from metrics import CommandMetrics, MetricsMiddleware, current_operation, metrics_response
+from rpc_client import RpcClient
+from tracing import CommandTracing, TracingMiddleware, configure_tracing, tracer
+from price_cache import PriceCache
 
-from time import sleep
 import logging
 import asyncio
 
@@ -17,16 +24,40 @@ LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
               '-35s %(lineno) -5d: %(message)s')
 LOGGER = logging.getLogger(__name__)
 
-rpc: QueueDispatcher
+# number of item prices one worker keeps in memory
+PRICE_CACHE_SIZE = int(os.environ.get('ORDER_PRICE_CACHE_SIZE', 100_000))
 
+# number of checkout sagas one worker settles concurrently
+SAGA_WORKERS = int(os.environ.get('ORDER_SAGA_WORKERS', 16))
+# how long a worker may hold a saga before another worker takes it over
+SAGA_LEASE_SECONDS = int(os.environ.get('ORDER_SAGA_LEASE_SECONDS', 30))
+# most unfinished sagas one recovery round puts on a worker's queue
+SAGA_RECOVERY_BATCH = int(os.environ.get('ORDER_SAGA_RECOVERY_BATCH', 1000))
 
+SAGA_PENDING = 'pending'
+SAGA_SETTLING = 'settling'
+SAGA_SUCCEEDED = 'succeeded'
+SAGA_FAILED = 'failed'
+
+rpc: RpcClient
+# filled from the prices in total_cost replies
+item_prices = PriceCache(PRICE_CACHE_SIZE)
+saga_queue: asyncio.Queue = asyncio.Queue()
+# the order ids on saga_queue, so that no saga waits on it twice
+queued_sagas: set[str] = set()
+
+
+configure_tracing("order-service")
 app = FastAPI(title="order-service")
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 
-client: pymongo.MongoClient = pymongo.MongoClient(
+client: AsyncIOMotorClient = AsyncIOMotorClient(
     host=os.environ['MONGO_HOST'],
     port=int(os.environ['MONGO_PORT']),
     username=os.environ['MONGO_USERNAME'],
     password=os.environ['MONGO_PASSWORD'],
+    event_listeners=[CommandMetrics(), CommandTracing()],
 )
 
 db = client["webDataManagement"]
@@ -34,6 +65,7 @@ db = client["webDataManagement"]
 orders = db["orders"]
 order_barrier = db["order_barrier"]
 cancel_order_barrier = db["cancel_order_barrier"]
+sagas = db["order_sagas"]
 
 logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 
@@ -44,21 +76,88 @@ def close_db_connection():
 
 @app.on_event('startup')
 async def startup():
-    sleep(10)
+    await asyncio.sleep(10)
     global rpc
-    rpc = await QueueDispatcher().connect()
+    rpc = await RpcClient().connect()
+
+    asyncio.create_task(migrate_orders())
+    await sagas.create_index("state")
+    for _ in range(SAGA_WORKERS):
+        asyncio.create_task(saga_worker())
+    asyncio.create_task(saga_recovery())
 
 gateway_url = os.environ["GATEWAY_URL"]
 
 atexit.register(close_db_connection)
 
 
+async def get_total_cost(counted_items: dict[str, int]) -> float:
+    # prices never change, so once every item's price is known locally the
+    # total is computed here without asking the stock service
+    prices = {item_id: item_prices.get(item_id) for item_id in counted_items}
+    if all(price is not None for price in prices.values()):
+        return sum(prices[item_id] * count for item_id, count in counted_items.items())
+
+    cost_response = await rpc.send_get_total_cost(counted_items)
+    if 'error' in cost_response:
+        raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY,
+                            f"could not find item info: {cost_response['error']}")
+    for item_id, price in cost_response['prices'].items():
+        item_prices.put(item_id, price)
+    return float(cost_response['total_cost'])
+
+
+def counted_items_of(order: dict) -> dict[str, int]:
+    # orders keep their items as {item_id: quantity}. orders written before
+    # that still hold a list with one entry per unit
+    items = order.get('items', {})
+    if isinstance(items, list):
+        return dict(Counter(items))
+    return items
+
+
+def item_list_of(order: dict) -> list[str]:
+    return [item_id for item_id, count in counted_items_of(order).items() for _ in range(count)]
+
+
+async def migrate_order(order_id: ObjectId) -> None:
+    # rewrites an order's item list into the counted representation. the
+    # filter on the old list makes a concurrent migration of the same order
+    # a no-op
+    order = await orders.find_one({"_id": order_id}, {"items": 1})
+    if order is not None and isinstance(order.get('items'), list):
+        await orders.update_one({"_id": order_id, "items": order['items']},
+                                {"$set": {"items": counted_items_of(order)}})
+
+
+async def migrate_orders() -> None:
+    migrated = 0
+    async for order in orders.find({"items": {"$type": "array"}}, {"_id": 1}):
+        await migrate_order(order['_id'])
+        migrated += 1
+    LOGGER.info("migrated %d orders to counted items", migrated)
+
+
+async def update_order_items(order_id: ObjectId, item_filter: dict, update: dict) -> dict:
+    # applies an update to an order's counted items, migrating an order that
+    # still holds an item list first. returns the updated order, or None when
+    # the filter did not match. the outcome of an earlier checkout no longer
+    # describes the changed items, so it is dropped
+    update_filter = {"_id": order_id, "items": {"$not": {"$type": "array"}}} | item_filter
+    update = update | {"$unset": {"paid": "", "total_cost": ""}}
+    order = await orders.find_one_and_update(update_filter, update, return_document=ReturnDocument.AFTER)
+    if order is None:
+        await migrate_order(order_id)
+        order = await orders.find_one_and_update(update_filter, update, return_document=ReturnDocument.AFTER)
+    return order
+
+
 @app.post('/create/{user_id}')
-def create_order(user_id):
+async def create_order(user_id):
     # POST - creates an order for the given user, and returns an order_id
     # Output JSON fields: “order_id”  - the order’s id
-    order = {"user_id": user_id}
-    orders.insert_one(order)
+    order = {"user_id": user_id, "items": {}}
+    await orders.insert_one(order)
 
     return {
         "order_id": str(order['_id'])
@@ -66,21 +165,21 @@ def create_order(user_id):
 
 
 @app.delete('/remove/{order_id}')
-def remove_order(order_id):
+async def remove_order(order_id):
     # DELETE - deletes an order by ID
-    if orders.delete_one({"_id": ObjectId(order_id)}).modified_count != 1:
+    if (await orders.delete_one({"_id": ObjectId(order_id)})).deleted_count != 1:
         raise HTTPException(400, f"Could not delete order {order_id}")
 
     return {"success": True}
 
 
 @app.post('/addItem/{order_id}/{item_id}')
-def add_item(order_id, item_id):
+async def add_item(order_id, item_id):
     # POST - adds a given item in the order given
-    if orders.update_one(
-        {"_id": ObjectId(order_id)},
-        {"$push": {"items": item_id}}
-    ).modified_count != 1:
+    # item ids are used as field names, so anything but an object id is refused
+    if not ObjectId.is_valid(item_id) or await update_order_items(
+        ObjectId(order_id), {}, {"$inc": {f"items.{item_id}": 1}}
+    ) is None:
         raise HTTPException(
             400, f"Could not add {item_id} to order {order_id}")
 
@@ -88,15 +187,20 @@ def add_item(order_id, item_id):
 
 
 @app.delete('/removeItem/{order_id}/{item_id}')
-def remove_item(order_id, item_id):
-    # DELETE - removes the given item from the given order
-    if orders.update_one(
-        {"_id": ObjectId(order_id)},
-        {"$pull": {"items": item_id}}
-    ).modified_count != 1:
+async def remove_item(order_id, item_id):
+    # DELETE - removes one unit of the given item from the given order
+    order = None
+    if ObjectId.is_valid(item_id):
+        order = await update_order_items(
+            ObjectId(order_id), {f"items.{item_id}": {"$gt": 0}}, {"$inc": {f"items.{item_id}": -1}})
+    if order is None:
         raise HTTPException(
             400, f"Could not remove {item_id} to order {order_id}")
 
+    if order['items'][item_id] <= 0:
+        await orders.update_one({"_id": order['_id'], f"items.{item_id}": {"$lte": 0}},
+                                {"$unset": {f"items.{item_id}": ""}})
+
     return {"success": True}
 
 
@@ -109,19 +213,22 @@ async def find_order(order_id):
     # “items”  - list of item ids that are included in the order
     # “user_id”  - the user’s id that made the order
     # “total_cost” - the total cost of the items in the order
-    order = orders.find_one({"_id": ObjectId(order_id)})
-    order_items = order["items"]
-
-    counted_items = dict(Counter(order_items))
-    cost_response = await rpc.send_get_total_cost(counted_items)
-    if 'error' in cost_response:
-        raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY,
-                            f"could not find item info: {cost_response['error']}")
-
-    total_cost = float(cost_response['total_cost'])
-
-    payment_resp = await rpc.send_payment_status(
-        str(order['user_id']), str(order['_id']))
+    order = await orders.find_one({"_id": ObjectId(order_id)})
+
+    if order.get('paid'):
+        # settled orders carry the outcome of their checkout
+        return {
+            'order_id': str(order['_id']),
+            'paid': True,
+            'items': item_list_of(order),
+            'user_id': str(order['user_id']),
+            'total_cost': float(order['total_cost'])
+        }
+
+    counted_items = counted_items_of(order)
+    total_cost, payment_resp = await asyncio.gather(
+        get_total_cost(counted_items),
+        rpc.send_payment_status(str(order['user_id']), str(order['_id'])))
     if 'error' in payment_resp:
         raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY,
                             f"could not find payment status: {payment_resp['error']}")
@@ -129,54 +236,283 @@ async def find_order(order_id):
     return {
         'order_id': str(order['_id']),
         'paid': payment_resp['paid'],
-        'items': order['items'],
+        'items': item_list_of(order),
         'user_id': str(order['user_id']),
         'total_cost': total_cost
     }
 
 
-@app.post('/checkout/{order_id}')
-async def checkout(order_id):
-    # POST - makes the payment (via calling the payment service),
-    # subtracts the stock (via the stock service)
-    # and returns a status (success/failure).
+def checkout_key(counted_items: dict[str, int]) -> str:
+    # tells the checkouts of one order apart by their items, so a payment
+    # made for other items is not taken for this checkout's
+    return hashlib.sha1(json.dumps(counted_items, sort_keys=True).encode()).hexdigest()
+
+
+async def settle_checkout(order_id: str, user_id: str, counted_items: dict[str, int], total_cost: float,
+                          sequential_legs: bool = False) -> None:
+    # makes the payment and subtracts the stock, undoing whichever of the two
+    # went through when the other did not. raises HTTPException on failure.
+    # the caller holds the order's saga lease, so no other attempt settles
+    # the order meanwhile and settling again after a failure is safe
+    key = checkout_key(counted_items)
+
+    # with the total known up front, payment and stock deduction are
+    # independent. sending them one after the other is only there to measure
+    # what running them concurrently saves
+    if sequential_legs:
+        payment_resp = await rpc.send_remove_credit(user_id, order_id, total_cost, key)
+        reserve_resp = await rpc.send_reserve_stock(counted_items, order_id)
+    else:
+        payment_resp, reserve_resp = await asyncio.gather(
+            rpc.send_remove_credit(user_id, order_id, total_cost, key),
+            rpc.send_reserve_stock(counted_items, order_id))
+
+    if payment_resp.get('timed_out') or reserve_resp.get('timed_out'):
+        # a request that timed out may still commit after we gave up on it,
+        # and one whose commit result is unknown may have committed, so
+        # undoing the other leg could lose the money or the stock. the
+        # checkout is settled again instead, which resends both requests and
+        # learns how they ended
+        raise HTTPException(HTTPStatus.GATEWAY_TIMEOUT,
+                            f"outcome of the checkout of order {order_id} is unknown, it is settled again")
+
+    # done also when an earlier attempt of this checkout paid or reserved the
+    # same, but not when the order's items changed since: a payment or a
+    # reservation made for other items is not ours to undo
+    paid = 'error' not in payment_resp and payment_resp['done']
+    reserved = 'error' not in reserve_resp and reserve_resp['done']
+    if paid and reserved:
+        # find_order serves settled orders from here without asking anyone,
+        # unless the items changed while the checkout ran
+        await orders.update_one({"_id": ObjectId(order_id), "items": counted_items},
+                                {"$set": {"paid": True, "total_cost": total_cost}})
+        return
+
+    async def refund():
+        refund_resp = await rpc.send_cancel_payment(user_id, order_id, key)
+        if 'error' in refund_resp or not refund_resp['done']:
+            LOGGER.exception("refund failed! %r", refund_resp.get('error'))
+            raise HTTPException(HTTPStatus.INTERNAL_SERVER_ERROR, "refund failed!")
 
-    order = orders.find_one({"_id": ObjectId(order_id)})
+    async def release():
+        release_resp = await rpc.send_release_stock(counted_items, order_id)
+        if 'error' in release_resp or not release_resp['done']:
+            LOGGER.exception("stock release failed! %r", release_resp.get('error'))
+            raise HTTPException(HTTPStatus.INTERNAL_SERVER_ERROR, "stock release failed!")
 
-    user_id = str(order['user_id'])
-    order_items = order['items']
+    # only undo the leg that went through. a leg that answered with an error
+    # or refused left nothing behind
+    await asyncio.gather(*([refund()] if paid else []), *([release()] if reserved else []))
 
-    counted_items = dict(Counter(order_items))
-    cost_response = await rpc.send_get_total_cost(counted_items)
-    if 'error' in cost_response:
+    if 'error' in reserve_resp:
         raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY,
-                            f"could not find item info: {cost_response['error']}")
-    if not cost_response['sufficient_stock']:
+                            f"could not reserve stock: {reserve_resp['error']}")
+    if reserve_resp.get('reservation') == 'mismatch':
+        raise HTTPException(HTTPStatus.CONFLICT,
+                            f"stock for order {order_id} is already reserved for other items")
+    if not reserved:
         raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY, f"not enough stock for order {order_id}")
-    total_cost = float(cost_response['total_cost'])
-
-    payment_resp = await rpc.send_remove_credit(user_id, order_id, total_cost)
     if 'error' in payment_resp:
         raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY,
                             f"could not make payment attempt {payment_resp['error']}")
-    if not payment_resp['done']:
-        raise HTTPException(HTTPStatus.PRECONDITION_FAILED,
-                            "insufficient funds for payment")
+    if payment_resp.get('payment') == 'mismatch':
+        raise HTTPException(HTTPStatus.CONFLICT,
+                            f"order {order_id} is already paid for other items")
+    raise HTTPException(HTTPStatus.PRECONDITION_FAILED,
+                        "insufficient funds for payment")
 
-    async def refund():
-        refund_resp = await rpc.send_cancel_payment(user_id, order_id)
-        if 'error' in refund_resp or not refund_resp['done']:
-            LOGGER.exception("refund failed! %r", refund_resp.get('error'))
-            raise HTTPException(HTTPStatus.INTERNAL_SERVER_ERROR, "refund failed!")
 
-    order_items_counts = dict(Counter(order["items"]))
-    stock_resp = await rpc.send_remove_multiple_stocks(order_items_counts, order_id)
-    if 'error' in stock_resp:
-        await refund()
-        raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY,
-                            f"could not deduct stocks because of error {stock_resp['error']}")
-    if not stock_resp['done']:
-        await refund()
-        raise HTTPException(HTTPStatus.PRECONDITION_FAILED,
-                            "could not deduct stocks because of insufficient quantities")
+@app.post('/checkout/{order_id}')
+async def checkout(order_id, sequential_legs: bool = False):
+    # POST - makes the payment (via calling the payment service),
+    # subtracts the stock (via the stock service)
+    # and returns a status (success/failure).
+    # with ?sequential_legs=true the two calls are made one after the other
+    # instead of concurrently, for comparing the latencies
+
+    order = await orders.find_one({"_id": ObjectId(order_id)})
+    if order.get('paid'):
+        # settled before, and the items did not change since
+        return {"done": True}
+
+    user_id = str(order['user_id'])
+    counted_items = counted_items_of(order)
+
+    total_cost = await get_total_cost(counted_items)
+    # the checkout is logged as a saga and leased like one, so it never runs
+    # at once with another checkout of the order, synchronous or not
+    now = datetime.utcnow()
+    try:
+        saga = await sagas.find_one_and_update(
+            {"_id": ObjectId(order_id)} | lease_free(now),
+            {"$set": {"user_id": user_id, "items": counted_items, "total_cost": total_cost, "state": SAGA_SETTLING,
+                      "lease_until": now + timedelta(seconds=SAGA_LEASE_SECONDS)},
+             "$unset": {"error": "", "status_code": ""},
+             "$setOnInsert": {"created_at": now}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        # the upsert found the saga leased by another attempt
+        raise HTTPException(HTTPStatus.CONFLICT, f"checkout of order {order_id} is already in progress")
+
+    try:
+        await settle_checkout(order_id, user_id, counted_items, total_cost, sequential_legs)
+    except HTTPException as e:
+        if e.status_code >= HTTPStatus.INTERNAL_SERVER_ERROR:
+            await hand_over_to_saga(saga)
+        else:
+            await finish_saga(saga, {"state": SAGA_FAILED, "status_code": e.status_code, "error": e.detail})
+        raise
+    except Exception:
+        await hand_over_to_saga(saga)
+        raise
+    await finish_saga(saga, {"state": SAGA_SUCCEEDED})
     return {"done": True}
+
+
+def lease_free(now: datetime) -> dict:
+    # matches sagas that no worker holds a lease on
+    return {"$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}]}
+
+
+async def finish_saga(saga: dict, fields: dict) -> None:
+    # records the outcome of a saga and gives up its lease, unless the lease
+    # ran out and another worker took the saga over meanwhile
+    await sagas.update_one({"_id": saga['_id'], "lease_until": saga['lease_until']},
+                           {"$set": fields, "$unset": {"lease_until": ""}})
+
+
+async def hand_over_to_saga(saga: dict) -> None:
+    # a checkout that ended in an unknown state, or with compensation left
+    # undone, stays a settling saga. giving up its lease lets a saga worker
+    # settle it again right away. its outcome shows in /checkout_status
+    LOGGER.warning("checkout of order %s did not finish, settling it in the background", saga['_id'])
+    await sagas.update_one({"_id": saga['_id'], "lease_until": saga['lease_until']}, {"$unset": {"lease_until": ""}})
+    queue_saga(str(saga['_id']))
+
+
+@app.post('/checkout_async/{order_id}', status_code=HTTPStatus.ACCEPTED)
+async def checkout_async(order_id):
+    # POST - records the checkout in the saga log and returns right away,
+    # a saga worker settles it in the background.
+    # Output JSON fields:
+    # “order_id”  - the order’s id
+    # “state” - the saga state, see /checkout_status
+    order = await orders.find_one({"_id": ObjectId(order_id)})
+    saga_fields = {"user_id": str(order['user_id']), "items": counted_items_of(order)}
+
+    saga = await sagas.find_one_and_update(
+        {"_id": ObjectId(order_id)},
+        {"$setOnInsert": saga_fields | {"state": SAGA_PENDING, "created_at": datetime.utcnow()}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+    if saga['state'] == SAGA_FAILED:
+        # a failed checkout can be tried again, like a synchronous one
+        saga = await sagas.find_one_and_update(
+            {"_id": ObjectId(order_id), "state": SAGA_FAILED},
+            {"$set": saga_fields | {"state": SAGA_PENDING}, "$unset": {"total_cost": "", "error": "", "status_code": ""}},
+            return_document=ReturnDocument.AFTER) or await sagas.find_one({"_id": ObjectId(order_id)})
+    if saga['state'] == SAGA_PENDING:
+        queue_saga(order_id)
+
+    return {'order_id': order_id, 'state': saga['state']}
+
+
+@app.get('/checkout_status/{order_id}')
+async def checkout_status(order_id):
+    # GET - returns the state of a checkout started with /checkout_async
+    # Output JSON fields:
+    # “order_id”  - the order’s id
+    # “state” - one of pending, settling, succeeded, failed
+    # “done” (true/false) - whether the checkout succeeded
+    # “error” - why the checkout failed, if it did
+    saga = await sagas.find_one({"_id": ObjectId(order_id)}, {"state": 1, "error": 1})
+    if saga is None:
+        raise HTTPException(HTTPStatus.NOT_FOUND, f"no checkout started for order {order_id}")
+
+    return {
+        'order_id': order_id,
+        'state': saga['state'],
+        'done': saga['state'] == SAGA_SUCCEEDED,
+        'error': saga.get('error'),
+    }
+
+
+@app.get('/metrics')
+async def metrics():
+    # GET - returns the metrics of this service in the prometheus text format
+    return metrics_response()
+
+
+@app.get('/rpc_stats')
+async def rpc_stats():
+    # GET - returns the outstanding requests of this worker's RPC client, and
+    # how many reads shared a request that was already outstanding
+    return rpc.stats()
+
+
+async def drive_saga(order_id: str) -> None:
+    # claims the saga with a lease, so that of all workers that pick it up
+    # only one drives it at a time
+    now = datetime.utcnow()
+    saga = await sagas.find_one_and_update(
+        {"_id": ObjectId(order_id), "state": {"$in": [SAGA_PENDING, SAGA_SETTLING]}} | lease_free(now),
+        {"$set": {"lease_until": now + timedelta(seconds=SAGA_LEASE_SECONDS)}},
+        return_document=ReturnDocument.AFTER)
+    if saga is None:
+        return
+
+    try:
+        # the total is logged before any money or stock moves, so a resumed
+        # saga settles exactly what it started with
+        total_cost = saga.get('total_cost')
+        if total_cost is None:
+            total_cost = await get_total_cost(saga['items'])
+            await sagas.update_one({"_id": saga['_id']}, {"$set": {"total_cost": total_cost, "state": SAGA_SETTLING}})
+
+        await settle_checkout(order_id, saga['user_id'], saga['items'], total_cost)
+    except HTTPException as e:
+        if e.status_code >= HTTPStatus.INTERNAL_SERVER_ERROR:
+            # a leg timed out or compensation did not finish. the lease
+            # runs out and the saga is settled again, resending the requests
+            LOGGER.error("saga for order %s could not be settled: %s", order_id, e.detail)
+            return
+        await finish_saga(saga, {"state": SAGA_FAILED, "status_code": e.status_code, "error": e.detail})
+    except Exception as e:
+        LOGGER.exception("saga for order %s interrupted: %r", order_id, e)
+    else:
+        await finish_saga(saga, {"state": SAGA_SUCCEEDED})
+
+
+def queue_saga(order_id: str) -> None:
+    if order_id not in queued_sagas:
+        queued_sagas.add(order_id)
+        saga_queue.put_nowait(order_id)
+
+
+async def saga_worker() -> None:
+    current_operation.set('saga')
+    while True:
+        order_id = await saga_queue.get()
+        queued_sagas.discard(order_id)
+        try:
+            # settling a saga is a trace of its own, apart from the request
+            # that started it
+            with tracer.start_as_current_span('drive_saga', attributes={'order_id': order_id}):
+                await drive_saga(order_id)
+        except Exception as e:
+            LOGGER.exception("saga worker failed on order %s: %r", order_id, e)
+
+
+async def saga_recovery() -> None:
+    # picks up unfinished sagas, first those left behind by an earlier run of
+    # the service and then those whose worker died or gave up on them. a saga
+    # without a lease is only picked up once it is older than a lease, until
+    # then the worker it was started on is expected to drive it
+    while True:
+        now = datetime.utcnow()
+        async for saga in sagas.find({"state": {"$in": [SAGA_PENDING, SAGA_SETTLING]},
+                                      "$or": [{"lease_until": {"$lt": now}},
+                                              {"lease_until": None,
+                                               "created_at": {"$lt": now - timedelta(seconds=SAGA_LEASE_SECONDS)}}]},
+                                     {"_id": 1}).limit(SAGA_RECOVERY_BATCH):
+            queue_saga(str(saga['_id']))
+        await asyncio.sleep(SAGA_LEASE_SECONDS)
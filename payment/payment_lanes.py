@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+import asyncio
+import logging
+import zlib
+from collections import Counter
+from typing import Any, Awaitable, Callable
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+
+
+class PaymentLanes(object):
+    """Runs submitted work on a fixed number of serial lanes.
+
+    Work is assigned to a lane by hashing its key, so everything submitted
+    with the same key runs one at a time and in submission order, while work
+    for keys on different lanes runs concurrently. This only holds within
+    one process: lanes of different processes know nothing of each other.
+    """
+
+    def __init__(self, lane_count: int, handler: Callable[[Any], Awaitable[None]]) -> None:
+        self.handler = handler
+        self.queues: list[asyncio.Queue] = [asyncio.Queue() for _ in range(lane_count)]
+        # keys of the work waiting in (or running on) each lane
+        self.pending: list[Counter] = [Counter() for _ in range(lane_count)]
+        self.workers: list[asyncio.Task] = []
+
+    def start(self) -> "PaymentLanes":
+        self.workers = [asyncio.create_task(self.run_lane(lane)) for lane in range(len(self.queues))]
+        return self
+
+    def lane_of(self, key: str) -> int:
+        # crc32 rather than hash(), which is salted per process, so that a key's
+        # lane is stable across restarts and the lane depths stay comparable
+        return zlib.crc32(key.encode()) % len(self.queues)
+
+    def submit(self, key: str, work: Any) -> None:
+        lane = self.lane_of(key)
+        self.pending[lane][key] += 1
+        self.queues[lane].put_nowait((key, work))
+
+    async def run_lane(self, lane: int) -> None:
+        queue = self.queues[lane]
+        while True:
+            key, work = await queue.get()
+            try:
+                await self.handler(work)
+            except Exception as e:
+                LOGGER.exception("[payment-lanes] lane %d failed handling work for %s: %r", lane, key, e)
+            finally:
+                self.pending[lane][key] -= 1
+                if self.pending[lane][key] == 0:
+                    del self.pending[lane][key]
+                queue.task_done()
+
+    def depths(self, hot_users: int = 3) -> list[dict]:
+        return [{
+            'lane': lane,
+            'depth': sum(self.pending[lane].values()),
+            'hot_users': [{'user_id': key, 'pending': count}
+                          for key, count in self.pending[lane].most_common(hot_users)],
+        } for lane in range(len(self.queues))]
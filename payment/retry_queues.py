@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+import logging
+
+from aio_pika import Message
+from aio_pika.abc import AbstractChannel, AbstractExchange, AbstractIncomingMessage
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+
+# header counting how often a message was retried
+ATTEMPT_HEADER = 'x-retry-attempt'
+
+
+class RetryQueues(object):
+    """Delays messages that cannot be handled yet, before handling them again.
+
+    Every delay has its own queue without consumers. Its messages expire
+    after the delay and are dead-lettered back onto the work queue, so a
+    waiting message neither spins through the handlers nor competes with
+    live traffic. The n-th retry of a message waits for the n-th delay, or
+    the last one once they run out. After ``attempts`` retries the message
+    is parked on ``<queue>.parked`` for someone to look at.
+    """
+
+    def __init__(self, queue: str, delays_ms: list[int], attempts: int) -> None:
+        self.queue = queue
+        self.delays_ms = delays_ms
+        self.attempts = attempts
+        self.parking_queue = f"{queue}.parked"
+
+    def delay_queue(self, delay_ms: int) -> str:
+        return f"{self.queue}.retry.{delay_ms}ms"
+
+    async def declare(self, channel: AbstractChannel) -> None:
+        for delay_ms in self.delays_ms:
+            await channel.declare_queue(self.delay_queue(delay_ms), arguments={
+                'x-message-ttl': delay_ms,
+                'x-dead-letter-exchange': '',
+                'x-dead-letter-routing-key': self.queue,
+            })
+        await channel.declare_queue(self.parking_queue)
+
+    async def retry(self, exchange: AbstractExchange, message: AbstractIncomingMessage) -> bool:
+        # publishes a copy of the message for a later attempt, or parks it.
+        # returns False when parked. the caller acknowledges the original
+        attempt = int((message.headers or {}).get(ATTEMPT_HEADER, 0)) + 1
+        # no expiration: the broker would dead-letter the copy as soon as
+        # the caller's deadline passed instead of after the delay
+        retried = Message(
+            message.body,
+            content_type=message.content_type,
+            content_encoding=message.content_encoding,
+            correlation_id=message.correlation_id,
+            reply_to=message.reply_to,
+            headers=dict(message.headers or {}) | {ATTEMPT_HEADER: attempt},
+        )
+
+        if attempt > self.attempts:
+            LOGGER.warning(f"Parking message {message.correlation_id} after {self.attempts} retries")
+            await exchange.publish(retried, routing_key=self.parking_queue)
+            return False
+
+        delay_ms = self.delays_ms[min(attempt, len(self.delays_ms)) - 1]
+        LOGGER.info(f"Retrying message {message.correlation_id} in {delay_ms}ms (attempt {attempt})")
+        await exchange.publish(retried, routing_key=self.delay_queue(delay_ms))
+        return True
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Iterable, MutableMapping
+
+
+class KeyedLock(object):
+    """A set of asyncio locks addressed by key.
+
+    Locks are created on demand and dropped again once nobody holds or waits
+    for them, so the mapping only ever contains keys that are in use.
+    """
+
+    def __init__(self) -> None:
+        self.locks: MutableMapping[str, asyncio.Lock] = {}
+        self.users: MutableMapping[str, int] = {}
+
+    @asynccontextmanager
+    async def acquire(self, keys: Iterable[str]) -> AsyncIterator[None]:
+        # always lock in sorted order so that two callers locking overlapping
+        # key sets can never deadlock on each other
+        keys = sorted(set(keys))
+        for key in keys:
+            self.users[key] = self.users.get(key, 0) + 1
+            if key not in self.locks:
+                self.locks[key] = asyncio.Lock()
+
+        acquired = []
+        try:
+            for key in keys:
+                await self.locks[key].acquire()
+                acquired.append(key)
+            yield
+        finally:
+            for key in acquired:
+                self.locks[key].release()
+            for key in keys:
+                self.users[key] -= 1
+                if self.users[key] == 0:
+                    del self.users[key]
+                    del self.locks[key]
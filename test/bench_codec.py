@@ -0,0 +1,63 @@
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'common'))
+
+import codec  # noqa: E402
+
+# Measures the encode and decode cost per message of every available wire format.
+# Usage: python test/bench_codec.py [repetitions]
+
+ITEM_ID = '62a4c2f5e13a5b3a9c0d1e2f'
+
+
+def item_dict(n_items: int) -> dict:
+    return {f"{i:024x}": i % 5 + 1 for i in range(n_items)}
+
+
+PAYLOADS = {
+    'find_item request': {'operation': 'find_item', 'item_id': ITEM_ID},
+    'find_item reply': {'item_id': ITEM_ID, 'stock': 35, 'price': 5.0},
+    'remove_credit request': {'operation': 'remove_credit', 'user_id': ITEM_ID, 'order_id': ITEM_ID, 'amount': 25.0},
+    'total_cost request (10 items)': {'operation': 'total_cost', 'item_dict': item_dict(10)},
+    'total_cost reply (10 items)': {'total_cost': 120.0, 'sufficient_stock': True,
+                                    'prices': {item_id: 4.5 for item_id in item_dict(10)}},
+    'reserve_stock request (1000 items)': {'operation': 'reserve_stock', 'item_dict': item_dict(1000),
+                                           'idem_key': ITEM_ID},
+}
+
+
+def formats() -> list[tuple[str, str, int]]:
+    # (name, content type, compression threshold)
+    found = [('json', codec.JSON)]
+    if codec.msgpack is not None:
+        found.append(('msgpack', codec.MSGPACK))
+    return [(name, content_type, 0) for name, content_type in found] + \
+        [(f"{name}+deflate", content_type, codec.RPC_COMPRESSION_THRESHOLD) for name, content_type in found]
+
+
+def bench(payload: dict, content_type: str, threshold: int, repetitions: int) -> tuple[float, float, int]:
+    body, content_type, content_encoding = codec.encode(payload, content_type, threshold)
+    assert codec.decode(body, content_type, content_encoding) == payload
+
+    encode_time = min(timeit.repeat(lambda: codec.encode(payload, content_type, threshold),
+                                    number=repetitions, repeat=5)) / repetitions
+    decode_time = min(timeit.repeat(lambda: codec.decode(body, content_type, content_encoding),
+                                    number=repetitions, repeat=5)) / repetitions
+    return encode_time, decode_time, len(body)
+
+
+def main(repetitions: int):
+    print(f"json backend: {'orjson' if codec.orjson is not None else 'json'}, "
+          f"msgpack: {'yes' if codec.msgpack is not None else 'no'}, "
+          f"compression threshold: {codec.RPC_COMPRESSION_THRESHOLD} bytes")
+    print(f"{'payload':<38}{'format':<18}{'encode us':>12}{'decode us':>12}{'bytes':>10}")
+    for name, payload in PAYLOADS.items():
+        for format_name, content_type, threshold in sorted(formats()):
+            encode_time, decode_time, size = bench(payload, content_type, threshold, repetitions)
+            print(f"{name:<38}{format_name:<18}{encode_time * 1e6:>12.2f}{decode_time * 1e6:>12.2f}{size:>10}")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
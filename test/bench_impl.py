@@ -0,0 +1,238 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Awaitable, Callable
+
+from bson import ObjectId
+from pymongo import MongoClient, monitoring
+from pymongo.errors import PyMongoError
+
+# Measures the *_impl functions of the stock and payment services directly,
+# against a single node replica set this script starts, without HTTP or the
+# broker in the way. Reports wall time, database round trips and transaction
+# retries per call and compares them with a baseline.
+# Usage: python test/bench_impl.py [--mongod PATH] [--iterations N] [--concurrency N] [--save-baseline]
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_impl_baseline.json')
+REPLICA_SET = 'bench'
+# the credentials the services log in with
+MONGO_USERNAME = 'root'
+MONGO_PASSWORD = 'mongo'
+# commands a connection sends for itself rather than for the operation
+CONNECTION_COMMANDS = frozenset(('hello', 'isMaster', 'ismaster', 'saslStart', 'saslContinue', 'endSessions'))
+# number of items in the orders that are priced and deducted
+ORDER_ITEMS = 10
+
+
+class RoundTrips(monitoring.CommandListener):
+    # counts the commands the services send. registered before the services
+    # create their clients, so it sees the commands of all of them
+
+    def __init__(self) -> None:
+        self.count = 0
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if event.command_name not in CONNECTION_COMMANDS:
+            self.count += 1
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        pass
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        pass
+
+
+def start_mongod(mongod: str, port: int, dbpath: str) -> subprocess.Popen:
+    process = subprocess.Popen([mongod, '--replSet', REPLICA_SET, '--port', str(port), '--dbpath', dbpath,
+                                '--bind_ip', '127.0.0.1', '--logpath', os.path.join(dbpath, 'mongod.log')])
+    client = MongoClient('127.0.0.1', port, directConnection=True, serverSelectionTimeoutMS=30_000)
+    client.admin.command('replSetInitiate', {'_id': REPLICA_SET, 'members': [{'_id': 0, 'host': f"127.0.0.1:{port}"}]})
+    deadline = time.monotonic() + 30
+    while not client.admin.command('hello').get('isWritablePrimary'):
+        if time.monotonic() > deadline:
+            raise TimeoutError("mongod did not become primary")
+        time.sleep(0.1)
+    # without --auth any user may log in, as long as it exists
+    client.admin.command('createUser', MONGO_USERNAME, pwd=MONGO_PASSWORD, roles=['root'])
+    client.close()
+    return process
+
+
+def load_service(name: str):
+    # both services are a module named app, so they are loaded under their
+    # own names. their siblings and the shared modules are importable from
+    # the search path
+    spec = importlib.util.spec_from_file_location(f"{name}_app", os.path.join(ROOT, name, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Bench(object):
+    """The benchmarked calls, each with the data it needs prepared untimed."""
+
+    def __init__(self, stock_app, payment_app) -> None:
+        self.stock_app = stock_app
+        self.payment_app = payment_app
+
+    async def setup(self, calls: int) -> None:
+        stock_app, payment_app = self.stock_app, self.payment_app
+        item_ids = [(await stock_app.create_item_impl(float(i + 1)))['item_id'] for i in range(ORDER_ITEMS)]
+        await stock_app.stock.update_many({}, {"$set": {"stock": float(calls)}})
+        self.item_dict = {item_id: 1 for item_id in item_ids}
+
+        self.user_id = (await payment_app.create_user_impl())['user_id']
+        await payment_app.add_credit_impl(self.user_id, float(calls))
+        # paid orders, for cancel_payment and payment_status to work on
+        self.paid_orders = [str(ObjectId()) for _ in range(calls)]
+        for order_id in self.paid_orders:
+            await payment_app.remove_credit_impl(self.user_id, order_id, 1.0)
+        await payment_app.add_credit_impl(self.user_id, float(calls))
+
+    def calls(self) -> dict[str, Callable[[int], Awaitable]]:
+        # every call gets its index, so calls that change state get data of their own
+        stock_app, payment_app = self.stock_app, self.payment_app
+        return {
+            'create_item_impl': lambda i: stock_app.create_item_impl(5.0),
+            'get_total_cost_impl': lambda i: stock_app.get_total_cost_impl(self.item_dict),
+            'remove_multiple_stocks_impl': lambda i: stock_app.remove_multiple_stocks_impl(
+                self.item_dict, str(ObjectId()), stock_app.pick_counters(self.item_dict)),
+            'remove_credit_impl': lambda i: payment_app.remove_credit_impl(self.user_id, str(ObjectId()), 1.0),
+            'cancel_payment_impl': lambda i: payment_app.cancel_payment_impl(self.user_id, self.paid_orders[i]),
+            'payment_status_impl': lambda i: payment_app.payment_status_impl(self.paid_orders[i]),
+        }
+
+    def retries(self) -> int:
+        return sum(self.stock_app.transactions.conflicts.values()) + \
+            sum(self.payment_app.transactions.conflicts.values())
+
+
+async def measure(bench: Bench, round_trips: RoundTrips, call: Callable[[int], Awaitable],
+                  indexes: range, concurrency: int) -> dict:
+    # runs the calls with the given indexes, concurrency at a time, all on
+    # the same items and user so that concurrent calls contend
+    latencies = []
+    commands, retries = round_trips.count, bench.retries()
+
+    async def worker(worker_indexes: range) -> None:
+        for i in worker_indexes:
+            start = time.perf_counter()
+            await call(i)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(indexes[w::concurrency]) for w in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p95_ms': latencies[min(len(latencies) - 1, len(latencies) * 95 // 100)] * 1000,
+        'calls_per_s': len(latencies) / elapsed,
+        'round_trips': (round_trips.count - commands) / len(latencies),
+        'retries': (bench.retries() - retries) / len(latencies),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result['p50_ms'] > before['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {before['p50_ms']:.2f}ms -> {result['p50_ms']:.2f}ms")
+        # round trips do not depend on the machine, so any increase counts
+        if result['round_trips'] > before['round_trips'] + 0.01:
+            regressions.append(f"{name}: round trips {before['round_trips']:.2f} -> {result['round_trips']:.2f}")
+    return regressions
+
+
+async def run(args: argparse.Namespace, round_trips: RoundTrips) -> dict:
+    stock_app, payment_app = load_service('stock'), load_service('payment')
+    # the services log every call
+    logging.getLogger().setLevel(logging.WARNING)
+
+    bench = Bench(stock_app, payment_app)
+    await bench.setup(args.warmup + args.iterations)
+    results = {}
+    for name, call in bench.calls().items():
+        await measure(bench, round_trips, call, range(args.warmup), 1)
+        results[name] = await measure(bench, round_trips, call, range(args.warmup, args.warmup + args.iterations),
+                                      args.concurrency)
+    return results
+
+
+def main(args: argparse.Namespace) -> int:
+    round_trips = RoundTrips()
+    monitoring.register(round_trips)
+
+    dbpath = tempfile.mkdtemp(prefix='bench-mongod-')
+    mongod = start_mongod(args.mongod, args.port, dbpath)
+    try:
+        os.environ.update(MONGO_HOST='127.0.0.1', MONGO_PORT=str(args.port),
+                          MONGO_USERNAME=MONGO_USERNAME, MONGO_PASSWORD=MONGO_PASSWORD)
+        sys.path[:0] = [os.path.join(ROOT, 'common'), os.path.join(ROOT, 'stock'), os.path.join(ROOT, 'payment')]
+        results = asyncio.run(run(args, round_trips))
+    except PyMongoError:
+        print(f"mongod log: {os.path.join(dbpath, 'mongod.log')}")
+        raise
+    finally:
+        mongod.terminate()
+        mongod.wait()
+    shutil.rmtree(dbpath, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored['concurrency'] == args.concurrency:
+            baseline = stored['results']
+        else:
+            print(f"baseline was taken with concurrency {stored['concurrency']}, not comparing")
+
+    print(f"{args.iterations} calls each, concurrency {args.concurrency}")
+    print(f"{'operation':<30}{'p50 ms':>10}{'p95 ms':>10}{'calls/s':>10}{'trips':>8}{'retries':>9}{'p50 vs base':>13}")
+    for name, result in results.items():
+        change = f"{result['p50_ms'] / baseline[name]['p50_ms'] - 1:+.0%}" if name in baseline else '-'
+        print(f"{name:<30}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['calls_per_s']:>10.0f}"
+              f"{result['round_trips']:>8.2f}{result['retries']:>9.3f}{change:>13}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'concurrency': args.concurrency, 'results': results}, f, indent=2)
+        print(f"saved baseline to {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    return 1 if regressions else 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the stock and payment operations")
+    parser.add_argument('--mongod', default=os.environ.get('MONGOD', 'mongod'), help="the mongod binary to start")
+    parser.add_argument('--port', type=int, default=27117)
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help="calls running at once; above 1 they contend on the same items and user")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="fraction by which p50 may exceed the baseline, default %(default)s")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
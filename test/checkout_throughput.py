@@ -0,0 +1,42 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import utils as tu
+
+# Measures checkout throughput against a running deployment.
+# Usage: python test/checkout_throughput.py [orders] [concurrency] [--url URL]
+
+
+def prepare_order(item_id: str) -> str:
+    user_id: str = tu.create_user()['user_id']
+    tu.add_credit_to_user(user_id, 10)
+    order_id: str = tu.create_order(user_id)['order_id']
+    tu.add_item_to_order(order_id, item_id)
+    return order_id
+
+
+def main(n_orders: int, concurrency: int):
+    item_id: str = tu.create_item(1)['item_id']
+    tu.add_stock(item_id, n_orders)
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        order_ids = list(pool.map(lambda _: prepare_order(item_id), range(n_orders)))
+
+        start = time.perf_counter()
+        status_codes = list(pool.map(lambda order_id: tu.checkout_order(order_id).status_code, order_ids))
+        elapsed = time.perf_counter() - start
+
+    succeeded = sum(1 for status_code in status_codes if tu.status_code_is_success(status_code))
+    print(f"{succeeded}/{n_orders} checkouts succeeded in {elapsed:.2f}s "
+          f"with concurrency {concurrency}: {n_orders / elapsed:.1f} checkouts/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Checkout throughput of a running deployment")
+    parser.add_argument('orders', type=int, nargs='?', default=200)
+    parser.add_argument('concurrency', type=int, nargs='?', default=32)
+    parser.add_argument('--url', default=tu.ORDER_URL, help="the gateway, default %(default)s")
+    args = parser.parse_args()
+    tu.ORDER_URL = tu.STOCK_URL = tu.PAYMENT_URL = args.url
+    main(args.orders, args.concurrency)
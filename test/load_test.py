@@ -0,0 +1,294 @@
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from typing import Awaitable, Optional
+
+import aiohttp
+
+# Drives the whole deployment with concurrent clients and reports latency and
+# throughput per endpoint, then checks that no money or stock went missing.
+# Usage: python test/load_test.py [--url URL] [--users N] [--items N] [--skew S]
+#                                 [--mix op=weight,...] [--concurrency N] [--duration SECONDS]
+# e.g. against docker-compose: python test/load_test.py --url http://localhost:8000
+
+DEFAULT_URL = os.environ.get('LOAD_TEST_URL', "http://localhost:8000")
+OPERATIONS = ('checkout', 'checkout_async', 'find_item', 'find_user', 'add_funds')
+DEFAULT_MIX = 'checkout=60,checkout_async=10,find_item=15,find_user=10,add_funds=5'
+# seconds the checkouts started with checkout_async get to settle at the end
+SETTLE_TIMEOUT = 60
+# tolerance when comparing sums of prices, which are floats
+EPSILON = 1e-6
+
+
+class Stats(object):
+    """Latencies and status codes of every request, per endpoint."""
+
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.statuses: dict[str, dict[int, int]] = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint: str, status: int, latency: float) -> None:
+        self.latencies[endpoint].append(latency)
+        self.statuses[endpoint][status] += 1
+
+    def report(self, elapsed: float) -> str:
+        lines = [f"{'endpoint':<32}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  statuses"]
+        for endpoint in sorted(self.latencies):
+            latencies = sorted(self.latencies[endpoint])
+            statuses = ' '.join(f"{status}:{count}" for status, count in sorted(self.statuses[endpoint].items()))
+            lines.append(f"{endpoint:<32}{len(latencies):>10}{len(latencies) / elapsed:>10.1f}"
+                         f"{percentile(latencies, 50) * 1000:>10.1f}{percentile(latencies, 95) * 1000:>10.1f}"
+                         f"{percentile(latencies, 99) * 1000:>10.1f}  {statuses}")
+        return '\n'.join(lines)
+
+
+def percentile(ordered: list[float], p: float) -> float:
+    # nearest rank
+    return ordered[max(0, min(len(ordered) - 1, round(p / 100 * len(ordered)) - 1))]
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for entry in mix.split(','):
+        operation, weight = entry.split('=')
+        if operation not in OPERATIONS:
+            raise ValueError(f"unknown operation {operation}, expected one of {', '.join(OPERATIONS)}")
+        weights[operation] = float(weight)
+    return weights
+
+
+class LoadTest(object):
+    """One run: creates users and items, sends the operation mix at them and
+    checks the invariants afterwards.
+
+    Every checkout orders a few items drawn from a Zipf distribution over
+    the items, so that with a skew above 0 a handful of items takes most of
+    the load, as best-sellers do.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, args: argparse.Namespace) -> None:
+        self.session = session
+        self.url = args.url.rstrip('/')
+        self.args = args
+        self.stats = Stats()
+        self.mix = parse_mix(args.mix)
+        self.user_ids: list[str] = []
+        self.item_ids: list[str] = []
+        self.prices: dict[str, float] = {}
+        # funds added per user beyond the initial credit, and the funds of
+        # requests that failed without saying whether they were added
+        self.added_funds: dict[str, float] = defaultdict(float)
+        self.uncertain_funds = 0.0
+        # cost of the checkouts the services reported as done, and the orders
+        # of asynchronous checkouts that still have to settle
+        self.confirmed_cost = 0.0
+        self.async_orders: dict[str, float] = {}
+        item_weights = [1 / rank ** args.skew for rank in range(1, args.items + 1)]
+        self.item_cum_weights = list(itertools.accumulate(item_weights))
+
+    async def request(self, method: str, endpoint: str, path: str) -> tuple[int, Optional[dict]]:
+        # endpoint names the request in the report, path is what is sent
+        start = time.perf_counter()
+        try:
+            async with self.session.request(method, f"{self.url}{path}") as response:
+                body = await response.json(content_type=None) if response.status < 300 else None
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            body, status = None, 0
+        self.stats.record(endpoint, status, time.perf_counter() - start)
+        return status, body
+
+    async def setup(self) -> None:
+        # the invariants start from these, so setup has to succeed completely
+        async def create_item(price: float) -> None:
+            _, item = await self.request('POST', 'POST /stock/item/create', f"/stock/item/create/{price}")
+            if item is None:
+                raise RuntimeError("could not create an item")
+            status, _ = await self.request('POST', 'POST /stock/add', f"/stock/add/{item['item_id']}/{self.args.stock}")
+            if not 200 <= status < 300:
+                raise RuntimeError(f"could not add stock to item {item['item_id']}: {status}")
+            self.item_ids.append(item['item_id'])
+            self.prices[item['item_id']] = price
+
+        async def create_user() -> None:
+            _, user = await self.request('POST', 'POST /payment/create_user', "/payment/create_user")
+            if user is None:
+                raise RuntimeError("could not create a user")
+            status, _ = await self.request('POST', 'POST /payment/add_funds',
+                                           f"/payment/add_funds/{user['user_id']}/{self.args.credit}")
+            if not 200 <= status < 300:
+                raise RuntimeError(f"could not add credit to user {user['user_id']}: {status}")
+            self.user_ids.append(user['user_id'])
+
+        # whole prices, so the invariants hold exactly
+        await limited([create_item(float(random.randint(1, 10))) for _ in range(self.args.items)], self.args.concurrency)
+        await limited([create_user() for _ in range(self.args.users)], self.args.concurrency)
+        # the most popular items are the first ones in cum_weights
+        random.shuffle(self.item_ids)
+
+    def pick_items(self) -> list[str]:
+        n_items = random.randint(1, self.args.max_order_items)
+        return random.choices(self.item_ids, cum_weights=self.item_cum_weights, k=n_items)
+
+    async def create_order(self) -> tuple[str, float]:
+        user_id = random.choice(self.user_ids)
+        _, order = await self.request('POST', 'POST /orders/create', f"/orders/create/{user_id}")
+        order_id = order['order_id']
+        cost = 0.0
+        for item_id in self.pick_items():
+            status, _ = await self.request('POST', 'POST /orders/addItem', f"/orders/addItem/{order_id}/{item_id}")
+            if 200 <= status < 300:
+                cost += self.prices[item_id]
+        return order_id, cost
+
+    async def checkout(self) -> None:
+        order_id, cost = await self.create_order()
+        status, _ = await self.request('POST', 'POST /orders/checkout', f"/orders/checkout/{order_id}")
+        if 200 <= status < 300:
+            self.confirmed_cost += cost
+
+    async def checkout_async(self) -> None:
+        order_id, cost = await self.create_order()
+        status, _ = await self.request('POST', 'POST /orders/checkout_async', f"/orders/checkout_async/{order_id}")
+        if 200 <= status < 300:
+            self.async_orders[order_id] = cost
+
+    async def find_item(self) -> None:
+        item_id = random.choices(self.item_ids, cum_weights=self.item_cum_weights)[0]
+        await self.request('GET', 'GET /stock/find', f"/stock/find/{item_id}")
+
+    async def find_user(self) -> None:
+        await self.request('GET', 'GET /payment/find_user', f"/payment/find_user/{random.choice(self.user_ids)}")
+
+    async def add_funds(self) -> None:
+        user_id = random.choice(self.user_ids)
+        amount = float(random.randint(1, 10))
+        status, _ = await self.request('POST', 'POST /payment/add_funds', f"/payment/add_funds/{user_id}/{amount}")
+        if 200 <= status < 300:
+            self.added_funds[user_id] += amount
+        elif status == 0 or status >= 500:
+            self.uncertain_funds += amount
+
+    async def client(self, deadline: float) -> None:
+        operations = list(self.mix)
+        cum_weights = list(itertools.accumulate(self.mix.values()))
+        while time.perf_counter() < deadline:
+            operation = random.choices(operations, cum_weights=cum_weights)[0]
+            try:
+                await getattr(self, operation)()
+            except (KeyError, TypeError):
+                # a setup step of the operation failed, which the stats show
+                pass
+
+    async def run(self) -> float:
+        start = time.perf_counter()
+        await asyncio.gather(*(self.client(start + self.args.duration) for _ in range(self.args.concurrency)))
+        return time.perf_counter() - start
+
+    async def settle(self) -> None:
+        # waits for the asynchronous checkouts, and counts those that succeeded
+        deadline = time.perf_counter() + SETTLE_TIMEOUT
+        pending = dict(self.async_orders)
+        while pending and time.perf_counter() < deadline:
+            for order_id, cost in list(pending.items()):
+                _, saga = await self.request('GET', 'GET /orders/checkout_status',
+                                             f"/orders/checkout_status/{order_id}")
+                if saga is not None and saga['state'] in ('succeeded', 'failed'):
+                    del pending[order_id]
+                    if saga['done']:
+                        self.confirmed_cost += cost
+            if pending:
+                await asyncio.sleep(1)
+        if pending:
+            print(f"{len(pending)} asynchronous checkouts did not settle in {SETTLE_TIMEOUT}s")
+
+    async def check_invariants(self) -> list[str]:
+        violations = []
+
+        sold_value = 0.0
+        for item_id in self.item_ids:
+            _, item = await self.request('GET', 'GET /stock/find', f"/stock/find/{item_id}")
+            if item is None:
+                violations.append(f"item {item_id} could not be read")
+                continue
+            if item['stock'] < 0:
+                violations.append(f"item {item_id} has negative stock {item['stock']}")
+            sold_value += (self.args.stock - item['stock']) * self.prices[item_id]
+
+        spent = 0.0
+        for user_id in self.user_ids:
+            _, user = await self.request('GET', 'GET /payment/find_user', f"/payment/find_user/{user_id}")
+            if user is None:
+                violations.append(f"user {user_id} could not be read")
+                continue
+            if user['credit'] < 0:
+                violations.append(f"user {user_id} has negative credit {user['credit']}")
+            spent += self.args.credit + self.added_funds[user_id] - user['credit']
+
+        # funds that may have been added unnoticed raise what the users spent
+        if not spent - EPSILON <= sold_value <= spent + self.uncertain_funds + EPSILON:
+            violations.append(f"users spent {spent:.2f} (up to {self.uncertain_funds:.2f} more) "
+                              f"on stock worth {sold_value:.2f}")
+        # checkouts that timed out may have gone through, so this is a lower bound
+        if self.confirmed_cost > spent + EPSILON:
+            violations.append(f"checkouts reported as done cost {self.confirmed_cost:.2f}, "
+                              f"but users only spent {spent:.2f}")
+        return violations
+
+
+async def limited(calls: list[Awaitable], concurrency: int) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(awaitable: Awaitable) -> None:
+        async with semaphore:
+            await awaitable
+
+    await asyncio.gather(*(call(awaitable) for awaitable in calls))
+
+
+async def main(args: argparse.Namespace) -> int:
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        load_test = LoadTest(session, args)
+        print(f"creating {args.items} items and {args.users} users")
+        await load_test.setup()
+
+        load_test.stats = Stats()
+        print(f"running {args.mix} with {args.concurrency} clients for {args.duration}s, item skew {args.skew}")
+        elapsed = await load_test.run()
+        print(load_test.stats.report(elapsed))
+
+        await load_test.settle()
+        violations = await load_test.check_invariants()
+
+    for violation in violations:
+        print(f"VIOLATION: {violation}")
+    print("invariants hold" if not violations else f"{len(violations)} invariants violated")
+    return 1 if violations else 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test of the whole deployment")
+    parser.add_argument('--url', default=DEFAULT_URL, help="the gateway, default %(default)s")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--stock', type=int, default=1000, help="initial stock of every item")
+    parser.add_argument('--credit', type=float, default=100.0, help="initial credit of every user")
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help="exponent of the Zipf distribution of item popularity, 0 for uniform")
+    parser.add_argument('--max-order-items', type=int, default=3)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="operations and their weights, default %(default)s")
+    parser.add_argument('--concurrency', type=int, default=32, help="number of clients sending at once")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds the mix runs for")
+    parser.add_argument('--timeout', type=float, default=30.0, help="seconds one request may take")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(parse_args())))
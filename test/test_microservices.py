@@ -1,3 +1,5 @@
+import statistics
+import time
 import unittest
 
 import utils as tu
@@ -37,6 +39,29 @@ class TestMicroservices(unittest.TestCase):
         stock_after_subtract: int = tu.find_item(item_id)['stock']
         self.assertEqual(stock_after_subtract, 35)
 
+    def test_split_stock(self):
+        item_id: str = tu.create_item(5)['item_id']
+        tu.add_stock(item_id, 10)
+
+        # Test /stock/split/<item_id>/<counters>
+        self.assertTrue(tu.status_code_is_success(tu.split_item(item_id, 4)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 10)
+
+        # subtractions take from the counters in turn, but see the whole stock
+        for _ in range(3):
+            self.assertTrue(tu.status_code_is_success(tu.subtract_stock(item_id, 3)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 1)
+        self.assertTrue(tu.status_code_is_failure(tu.subtract_stock(item_id, 2)))
+
+        tu.add_stock(item_id, 5)
+        self.assertTrue(tu.status_code_is_success(tu.subtract_stock(item_id, 6)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 0)
+
+        # a single counter merges the stock back into the item
+        tu.add_stock(item_id, 2)
+        self.assertTrue(tu.status_code_is_success(tu.split_item(item_id, 1)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 2)
+
     def test_payment(self):
         # Test /payment/pay/<user_id>/<order_id>
         user: dict = tu.create_user()
@@ -148,6 +173,33 @@ class TestMicroservices(unittest.TestCase):
         credit: int = tu.find_user(user_id)['credit']
         self.assertEqual(credit, 5)
 
+        order: dict = tu.find_order(order_id)
+        self.assertTrue(order['paid'])
+        self.assertEqual(order['total_cost'], 10)
+
+    def test_order_items(self):
+        user_id: str = tu.create_user()['user_id']
+        order_id: str = tu.create_order(user_id)['order_id']
+        item_id_1 = self.create_item_with_cost_and_stock(5, 10)
+        item_id_2 = self.create_item_with_cost_and_stock(2, 10)
+
+        self.assertTrue(tu.status_code_is_success(tu.add_item_to_order(order_id, item_id_1)))
+        self.assertTrue(tu.status_code_is_success(tu.add_item_to_order(order_id, item_id_1)))
+        self.assertTrue(tu.status_code_is_success(tu.add_item_to_order(order_id, item_id_2)))
+
+        order: dict = tu.find_order(order_id)
+        self.assertEqual(sorted(order['items']), sorted([item_id_1, item_id_1, item_id_2]))
+        self.assertEqual(order['total_cost'], 12)
+
+        # removing an item takes away a single unit of it
+        self.assertTrue(tu.status_code_is_success(tu.remove_item_from_order(order_id, item_id_1)))
+        self.assertTrue(tu.status_code_is_success(tu.remove_item_from_order(order_id, item_id_2)))
+        self.assertTrue(tu.status_code_is_failure(tu.remove_item_from_order(order_id, item_id_2)))
+
+        order = tu.find_order(order_id)
+        self.assertEqual(order['items'], [item_id_1])
+        self.assertEqual(order['total_cost'], 5)
+
     def create_item_with_cost_and_stock(self, cost: float, stock: int):
         item: dict = tu.create_item(cost)
         self.assertTrue('item_id' in item)
@@ -254,5 +306,63 @@ class TestMicroservices(unittest.TestCase):
         credit_after_payment: int = tu.find_user(user_id)['credit']
         self.assertEqual(credit_after_payment, 975)
 
+    def wait_for_checkout(self, order_id: str, timeout: float = 30) -> dict:
+        deadline = time.monotonic() + timeout
+        status: dict = tu.checkout_status(order_id)
+        while status['state'] not in ('succeeded', 'failed') and time.monotonic() < deadline:
+            time.sleep(0.1)
+            status = tu.checkout_status(order_id)
+        return status
+
+    def test_checkout_async(self):
+        user_id: str = tu.create_user()['user_id']
+        order_id: str = tu.create_order(user_id)['order_id']
+        item_id = self.create_item_with_cost_and_stock(5, 10)
+        self.assertTrue(tu.status_code_is_success(tu.add_item_to_order(order_id, item_id)))
+
+        # checkout fails in the background because the user has no credit
+        checkout_response = tu.checkout_order_async(order_id)
+        self.assertEqual(checkout_response.status_code, 202)
+        status: dict = self.wait_for_checkout(order_id)
+        self.assertEqual(status['state'], 'failed')
+        self.assertFalse(status['done'])
+        self.assertEqual(tu.find_item(item_id)['stock'], 10)
+
+        # after adding credit the same checkout can be started again
+        self.assertTrue(tu.status_code_is_success(tu.add_credit_to_user(user_id, 10)))
+        checkout_response = tu.checkout_order_async(order_id)
+        self.assertEqual(checkout_response.status_code, 202)
+        status = self.wait_for_checkout(order_id)
+        self.assertEqual(status['state'], 'succeeded')
+        self.assertTrue(status['done'])
+
+        self.assertEqual(tu.find_user(user_id)['credit'], 5)
+        self.assertEqual(tu.find_item(item_id)['stock'], 9)
+
+    def test_checkout_latency(self):
+        # compares checkout, which runs payment and stock deduction concurrently,
+        # with the same checkout running them one after the other. the two
+        # kinds alternate so both see the same load
+        rounds = 20
+        item_id = self.create_item_with_cost_and_stock(1, 2 * rounds)
+        latencies = {False: [], True: []}
+
+        for i in range(2 * rounds):
+            sequential_legs = i % 2 == 1
+            user_id: str = tu.create_user()['user_id']
+            self.assertTrue(tu.status_code_is_success(tu.add_credit_to_user(user_id, 1)))
+            order_id: str = tu.create_order(user_id)['order_id']
+            self.assertTrue(tu.status_code_is_success(tu.add_item_to_order(order_id, item_id)))
+
+            start = time.perf_counter()
+            self.assertTrue(tu.status_code_is_success(tu.checkout_order(order_id, sequential_legs).status_code))
+            latencies[sequential_legs].append(time.perf_counter() - start)
+
+        concurrent, sequential = statistics.median(latencies[False]), statistics.median(latencies[True])
+        print(f"checkout median latency {concurrent * 1000:.1f}ms with concurrent legs, "
+              f"{sequential * 1000:.1f}ms with sequential legs ({(concurrent - sequential) * 1000:+.1f}ms)")
+        self.assertLess(concurrent, sequential)
+        self.assertEqual(tu.find_item(item_id)['stock'], 0)
+
 if __name__ == '__main__':
     unittest.main()
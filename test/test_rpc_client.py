@@ -0,0 +1,171 @@
+import asyncio
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+from typing import Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'common'))
+
+import codec  # noqa: E402
+from rpc_client import RpcClient, error_reply  # noqa: E402
+from transactions import UnknownCommitResultError  # noqa: E402
+
+# Runs without a broker: requests are answered in-process by a handler.
+
+
+class FakeExchange(object):
+    """Answers every published request with what the handler returns for it,
+    or not at all for None. Replies wait until ``gate`` is set."""
+
+    def __init__(self, client: RpcClient, handler: Callable[[dict], dict]) -> None:
+        self.client = client
+        self.handler = handler
+        self.requests: list[dict] = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def publish(self, message, routing_key: str) -> None:
+        request = codec.decode(message.body, message.content_type, message.content_encoding)
+        self.requests.append(request)
+        reply = self.handler(request)
+        if reply is not None:
+            asyncio.create_task(self.reply(message.correlation_id, reply))
+
+    async def reply(self, correlation_id: str, reply: dict) -> None:
+        await self.gate.wait()
+        body, content_type, content_encoding = codec.encode(reply)
+        self.client.on_response(SimpleNamespace(correlation_id=correlation_id, body=body, content_type=content_type,
+                                                content_encoding=content_encoding))
+
+    def operations(self) -> list[str]:
+        return [request['operation'] for request in self.requests]
+
+
+def answer(request: dict) -> dict:
+    if request['operation'] == 'batch':
+        return {'replies': [answer(r) for r in request['requests']]}
+    if request['operation'] == 'find_item':
+        return {'item_id': request['item_id'], 'stock': 1, 'price': 1.0}
+    if request['operation'] == 'find_user':
+        return {'user_id': request['user_id'], 'credit': 1.0}
+    return {'done': True}
+
+
+class RpcClientTestCase(unittest.IsolatedAsyncioTestCase):
+    def client(self, handler: Callable[[dict], dict] = answer, **kwargs) -> tuple[RpcClient, FakeExchange]:
+        client = RpcClient(**kwargs)
+        exchange = FakeExchange(client, handler)
+        client.channel = SimpleNamespace(default_exchange=exchange)
+        return client, exchange
+
+
+class TestSend(RpcClientTestCase):
+    async def test_reply(self):
+        client, exchange = self.client()
+        self.assertEqual(await client.send_add_stock('a', 1), {'done': True})
+        self.assertEqual(exchange.requests, [{'operation': 'add_stock', 'item_id': 'a', 'amount': 1}])
+        self.assertEqual(client.futures, {})
+
+    async def test_timeout(self):
+        client, _ = self.client(lambda request: None, timeout=0.01)
+        resp = await client.send_add_stock('a', 1)
+        self.assertIn('RpcTimeoutError', resp['error'])
+        self.assertTrue(resp['timed_out'])
+        self.assertEqual(client.futures, {})
+
+    def test_unknown_commit_result_is_answered_as_timed_out(self):
+        self.assertTrue(error_reply(UnknownCommitResultError("add_stock may or may not have committed"))['timed_out'])
+        self.assertEqual(error_reply(ValueError("bad")), {'error': "ValueError('bad')"})
+
+
+class TestBatching(RpcClientTestCase):
+    async def test_concurrent_reads_share_a_batch(self):
+        client, exchange = self.client(batch_window=0.01)
+        replies = await asyncio.gather(*(client.send_find_item(item_id) for item_id in 'abc'))
+        self.assertEqual([reply['item_id'] for reply in replies], ['a', 'b', 'c'])
+        self.assertEqual(exchange.operations(), ['batch'])
+        self.assertEqual([r['item_id'] for r in exchange.requests[0]['requests']], ['a', 'b', 'c'])
+
+    async def test_full_batch_is_sent_before_the_window_ends(self):
+        client, exchange = self.client(batch_window=60, batch_size=2)
+        replies = await asyncio.wait_for(asyncio.gather(client.send_find_item('a'), client.send_find_item('b')), 1)
+        self.assertEqual([reply['item_id'] for reply in replies], ['a', 'b'])
+        self.assertEqual(exchange.operations(), ['batch'])
+
+    async def test_single_read_is_sent_plainly(self):
+        client, exchange = self.client(batch_window=0.001)
+        self.assertEqual((await client.send_find_item('a'))['item_id'], 'a')
+        self.assertEqual(exchange.operations(), ['find_item'])
+
+    async def test_batch_error_reaches_every_caller(self):
+        client, _ = self.client(lambda request: {'error': 'boom'}, batch_window=0.01)
+        replies = await asyncio.gather(*(client.send_find_item(item_id) for item_id in 'abc'))
+        self.assertEqual(replies, [{'error': 'boom'}] * 3)
+
+    async def test_batch_exception_reaches_every_caller(self):
+        client, exchange = self.client(batch_window=0.01)
+
+        async def publish(message, routing_key):
+            raise ConnectionError("channel closed")
+        exchange.publish = publish
+
+        results = await asyncio.gather(*(client.send_find_item(item_id) for item_id in 'abc'), return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ConnectionError) for result in results))
+
+    async def test_batching_off(self):
+        client, exchange = self.client(batch_size=1)
+        await asyncio.gather(*(client.send_find_item(item_id) for item_id in 'ab'))
+        self.assertEqual(exchange.operations(), ['find_item', 'find_item'])
+
+
+class TestSharing(RpcClientTestCase):
+    async def test_identical_reads_share_a_request(self):
+        client, exchange = self.client()
+        exchange.gate.clear()
+        reads = [asyncio.create_task(client.send_find_user('u')) for _ in range(3)]
+        await asyncio.sleep(0)
+        exchange.gate.set()
+        replies = await asyncio.gather(*reads)
+        self.assertEqual(replies, [{'user_id': 'u', 'credit': 1.0}] * 3)
+        self.assertEqual(exchange.operations(), ['find_user'])
+        self.assertEqual(client.stats()['shared']['find_user'], {'hits': 2, 'misses': 1})
+
+    async def test_different_reads_are_not_shared(self):
+        client, exchange = self.client()
+        await asyncio.gather(client.send_find_user('u'), client.send_find_user('v'))
+        self.assertEqual(exchange.operations(), ['find_user', 'find_user'])
+
+    async def test_finished_read_is_not_reused(self):
+        client, exchange = self.client()
+        await client.send_find_user('u')
+        await client.send_find_user('u')
+        self.assertEqual(exchange.operations(), ['find_user', 'find_user'])
+
+    async def test_write_clears_shared_reads(self):
+        client, exchange = self.client()
+        exchange.gate.clear()
+        before = asyncio.create_task(client.send_find_user('u'))
+        write = asyncio.create_task(client.send_add_credit('u', 1.0))
+        await asyncio.sleep(0)
+        exchange.gate.set()
+        await write
+        # sent while the first read is still in flight, which may predate the write
+        after = asyncio.create_task(client.send_find_user('u'))
+        await asyncio.gather(before, after)
+        self.assertEqual(sorted(exchange.operations()), ['add_credit', 'find_user', 'find_user'])
+
+    async def test_caller_giving_up_does_not_cancel_the_others(self):
+        client, exchange = self.client()
+        exchange.gate.clear()
+        first = asyncio.create_task(client.send_find_user('u'))
+        second = asyncio.create_task(client.send_find_user('u'))
+        await asyncio.sleep(0)
+        first.cancel()
+        exchange.gate.set()
+        self.assertEqual(await second, {'user_id': 'u', 'credit': 1.0})
+        self.assertEqual(exchange.operations(), ['find_user'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'common'))
+
+from pymongo.errors import PyMongoError  # noqa: E402
+
+import transactions  # noqa: E402
+from transactions import (  # noqa: E402
+    TRANSIENT_ERROR, UNKNOWN_COMMIT_RESULT, TransactionRunner, UnknownCommitResultError
+)
+
+# Runs without mongo: the session fails commits as scripted.
+
+
+class FakeSession(object):
+    def __init__(self, commit_errors: list) -> None:
+        self.commit_errors = commit_errors
+        self.in_transaction = False
+        self.commits = 0
+        self.aborts = 0
+
+    async def __aenter__(self) -> "FakeSession":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        pass
+
+    def start_transaction(self) -> None:
+        self.in_transaction = True
+
+    async def abort_transaction(self) -> None:
+        self.in_transaction = False
+        self.aborts += 1
+
+    async def commit_transaction(self) -> None:
+        if self.commit_errors:
+            raise self.commit_errors.pop(0)
+        self.in_transaction = False
+        self.commits += 1
+
+
+class FakeClient(object):
+    def __init__(self, commit_errors: list = ()) -> None:
+        self.session = FakeSession(list(commit_errors))
+
+    async def start_session(self) -> FakeSession:
+        return self.session
+
+
+def transient_error() -> PyMongoError:
+    return PyMongoError("write conflict", error_labels=[TRANSIENT_ERROR])
+
+
+@mock.patch.object(transactions, 'backoff', return_value=0)
+class TestTransactionRunner(unittest.IsolatedAsyncioTestCase):
+    async def test_commits_once(self, _):
+        client = FakeClient()
+        runner = TransactionRunner(client)
+
+        async def body(session):
+            return 'result'
+
+        self.assertEqual(await runner.run('op', ['key'], body), 'result')
+        self.assertEqual(client.session.commits, 1)
+        self.assertEqual(runner.stats()['conflicts'], {})
+
+    async def test_transient_error_retries_body(self, _):
+        client = FakeClient()
+        runner = TransactionRunner(client)
+        runs = []
+
+        async def body(session):
+            runs.append(1)
+            if len(runs) < 3:
+                raise transient_error()
+            return 'result'
+
+        self.assertEqual(await runner.run('op', ['key'], body), 'result')
+        self.assertEqual(len(runs), 3)
+        self.assertEqual(client.session.aborts, 2)
+        self.assertEqual(client.session.commits, 1)
+        self.assertEqual(runner.stats()['conflicts'], {'op': 2})
+        self.assertEqual(runner.stats()['hot_keys'], {'key': 2})
+
+    async def test_transient_commit_error_retries_body(self, _):
+        client = FakeClient([transient_error()])
+        runner = TransactionRunner(client)
+        runs = []
+
+        async def body(session):
+            runs.append(1)
+
+        await runner.run('op', ['key'], body)
+        self.assertEqual(len(runs), 2)
+        self.assertEqual(client.session.commits, 1)
+
+    async def test_unknown_commit_result_retries_only_commit(self, _):
+        client = FakeClient([PyMongoError("timeout", error_labels=[UNKNOWN_COMMIT_RESULT])] * 2)
+        runner = TransactionRunner(client)
+        runs = []
+
+        async def body(session):
+            runs.append(1)
+            return 'result'
+
+        self.assertEqual(await runner.run('op', ['key'], body), 'result')
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(client.session.commits, 1)
+        self.assertEqual(runner.stats()['conflicts'], {})
+
+    async def test_unknown_commit_result_after_budget(self, _):
+        client = FakeClient([PyMongoError("timeout", error_labels=[UNKNOWN_COMMIT_RESULT])] * 3)
+        runner = TransactionRunner(client, budget=0)
+        runs = []
+
+        async def body(session):
+            runs.append(1)
+
+        with self.assertRaises(UnknownCommitResultError):
+            await runner.run('op', ['key'], body)
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(client.session.commits, 0)
+
+    async def test_other_errors_are_not_retried(self, _):
+        client = FakeClient()
+        runner = TransactionRunner(client)
+        runs = []
+
+        async def body(session):
+            runs.append(1)
+            raise PyMongoError("duplicate key")
+
+        with self.assertRaises(PyMongoError):
+            await runner.run('op', ['key'], body)
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(client.session.aborts, 1)
+
+        async def failing_body(session):
+            raise ValueError("not a mongo error")
+
+        with self.assertRaises(ValueError):
+            await runner.run('op', ['key'], failing_body)
+        self.assertEqual(client.session.aborts, 2)
+        self.assertEqual(runner.stats()['failures'], {})
+
+    async def test_gives_up_after_max_attempts(self, _):
+        client = FakeClient()
+        runner = TransactionRunner(client, max_attempts=4)
+        runs = []
+
+        async def body(session):
+            runs.append(1)
+            raise transient_error()
+
+        with self.assertRaises(PyMongoError):
+            await runner.run('op', ['a', 'b'], body)
+        self.assertEqual(len(runs), 4)
+        self.assertEqual(runner.stats()['failures'], {'op': 1})
+        self.assertEqual(runner.stats()['hot_keys'], {'a': 4, 'b': 4})
+
+    async def test_gives_up_after_budget(self, _):
+        client = FakeClient()
+        runner = TransactionRunner(client, max_attempts=100, budget=0)
+        runs = []
+
+        async def body(session):
+            runs.append(1)
+            raise transient_error()
+
+        with self.assertRaises(PyMongoError):
+            await runner.run('op', ['key'], body)
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(runner.stats()['failures'], {'op': 1})
+
+    async def test_body_may_abort(self, _):
+        client = FakeClient()
+        runner = TransactionRunner(client)
+
+        async def body(session):
+            await session.abort_transaction()
+            return False
+
+        self.assertFalse(await runner.run('op', ['key'], body))
+        self.assertEqual(client.session.commits, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,6 +22,10 @@ def subtract_stock(item_id: str, amount: int) -> int:
     return requests.post(f"{STOCK_URL}/stock/subtract/{item_id}/{amount}").status_code
 
 
+def split_item(item_id: str, counters: int) -> int:
+    return requests.post(f"{STOCK_URL}/stock/split/{item_id}/{counters}").status_code
+
+
 ########################################################################################################################
 #   PAYMENT MICROSERVICE FUNCTIONS
 ########################################################################################################################
@@ -57,12 +61,25 @@ def add_item_to_order(order_id: str, item_id: str) -> int:
     return requests.post(f"{ORDER_URL}/orders/addItem/{order_id}/{item_id}").status_code
 
 
+def remove_item_from_order(order_id: str, item_id: str) -> int:
+    return requests.delete(f"{ORDER_URL}/orders/removeItem/{order_id}/{item_id}").status_code
+
+
 def find_order(order_id: str) -> dict:
     return requests.get(f"{ORDER_URL}/orders/find/{order_id}").json()
 
 
-def checkout_order(order_id: str) -> requests.Response:
-    return requests.post(f"{ORDER_URL}/orders/checkout/{order_id}")
+def checkout_order(order_id: str, sequential_legs: bool = False) -> requests.Response:
+    params = {'sequential_legs': 'true'} if sequential_legs else None
+    return requests.post(f"{ORDER_URL}/orders/checkout/{order_id}", params=params)
+
+
+def checkout_order_async(order_id: str) -> requests.Response:
+    return requests.post(f"{ORDER_URL}/orders/checkout_async/{order_id}")
+
+
+def checkout_status(order_id: str) -> dict:
+    return requests.get(f"{ORDER_URL}/orders/checkout_status/{order_id}").json()
 
 
 ########################################################################################################################